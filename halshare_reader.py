@@ -6,10 +6,14 @@ APK解析に基づいた完全実装 + CSV出力機能
 
 import asyncio
 from bleak import BleakClient
-from datetime import datetime, timedelta
+from datetime import datetime
 import struct
+from array import array
+from itertools import chain, islice
 import sys
+import time
 import csv
+import logging
 
 # デバイス情報
 # DEVICE_ADDRESS = "2CA47633-6714-12F0-F7A0-C78F81C5A61A" # 4N036
@@ -30,13 +34,58 @@ READ_CHAR_UUID = "169bb1bb-ae80-4650-bf4b-afb79f38422a"
 BASE_TEMPERATURE = 25.0
 CELSIUS_PER_LSB = 0.0625
 
+# 推奨ATT MTU（APKでは250に設定）
+PREFERRED_MTU = 247
+
+# CSV書き込みバッファサイズ（大量データ時のwrite回数を削減）
+CSV_BUFFER_SIZE = 1 << 20
+
+# エンコード済みコマンドのキャッシュ（コマンド文字列 → 送信バイト列）
+_CMD_CACHE = {}
+
+logger = logging.getLogger(__name__)
+
+# 温度変換テーブル（生データ 0x00〜0xFF → 温度）
+_TEMP_LUT = tuple(i * CELSIUS_PER_LSB + BASE_TEMPERATURE for i in range(256))
+
+# CSVの列名（generate_csv_data() の行タプルはこの順）
+CSV_FIELDNAMES = ('halshareWearerName', 'halshareId', 'datetime', 'temperature')
+
+
+def parse_packet(data, intervals, temps, raw_bytes):
+    """
+    温度データパケット（時間間隔 + 温度 の2バイト × N）をパースし、
+    各配列の末尾に追加する
+    追加したサンプル数を返す
+    """
+    # 2バイトずつ（時間間隔 + 温度）をスライスで一括分離
+    # frombytes() はバッファを直接コピーするため、1バイトずつのint化を行わない
+    temps_raw = data[1::2]
+    intervals.frombytes(data[0::2])
+    temps.extend(map(_TEMP_LUT.__getitem__, temps_raw))
+    raw_bytes.frombytes(temps_raw)
+    return len(temps_raw)
+
+
+def format_timestamp(epoch):
+    """
+    エポック秒をCSVの日時文字列（YYYY/MM/DD HH:MM:SS、ローカル時刻）に変換
+    datetime.strftime() より軽量なf-string整形
+    """
+    tm = time.localtime(epoch)
+    return (f"{tm.tm_year}/{tm.tm_mon:02d}/{tm.tm_mday:02d} "
+            f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}")
+
 
 class HalshareReader:
     def __init__(self, address):
         self.address = address
         self.client = None
-        self.data_buffer = []
-        self.measurement_complete = False
+        # 測定データは列ごとの配列で保持（時間間隔[分], 温度[°C], 生データ）
+        self.intervals = array('B')
+        self.temps = array('f')
+        self.raw_bytes = array('B')
+        self.measurement_complete = asyncio.Event()
         self.data_acquisition_time = None  # データ取得完了時刻
         
     def calculate_temperature(self, byte_value):
@@ -44,17 +93,37 @@ class HalshareReader:
         バイト値から温度を計算
         APKの toTemperature() 実装に基づく
         """
-        # バイト値を符号なし整数に変換
-        unsigned_value = byte_value if byte_value >= 0 else byte_value + 256
-        temperature = (unsigned_value * CELSIUS_PER_LSB) + BASE_TEMPERATURE
-        return temperature
+        # & 0xFF で符号なしに揃えてテーブルを参照
+        return _TEMP_LUT[byte_value & 0xFF]
     
     async def connect(self):
         """デバイスに接続"""
         print(f"デバイスに接続中: {self.address}")
         self.client = BleakClient(self.address)
         await self.client.connect()
-        print("✓ 接続成功\n")
+        print("✓ 接続成功")
+        await self.check_mtu()
+        print()
+    
+    async def check_mtu(self):
+        """
+        ネゴシエーション済みのMTUを取得して表示
+        MTU交換はOS側が接続時に行う（bleakから値は指定できない）
+        BlueZではMTU値の取得に明示的な問い合わせが必要
+        """
+        backend = getattr(self.client, "_backend", None)
+        acquire_mtu = getattr(backend, "_acquire_mtu", None)
+        if acquire_mtu is not None:
+            try:
+                await acquire_mtu()
+            except Exception as e:
+                print(f"⚠ MTU取得に失敗しました: {e}")
+        
+        mtu = self.client.mtu_size
+        if mtu < PREFERRED_MTU:
+            print(f"  MTU: {mtu}（推奨値 {PREFERRED_MTU} 未満）")
+        else:
+            print(f"  MTU: {mtu}")
         
     async def setup_notification(self):
         """
@@ -65,37 +134,35 @@ class HalshareReader:
         
         def notification_handler(sender, data):
             """データ受信時のコールバック"""
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-            
-            print(f"[{timestamp}] データ受信:")
-            print(f"  Hex: {data.hex()}")
-            print(f"  長さ: {len(data)} bytes")
+            # パケット毎の出力はDEBUG時のみ（hex()や文字列整形も行わない）
+            debug = logger.isEnabledFor(logging.DEBUG)
+            if debug:
+                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+                logger.debug(f"[{timestamp}] データ受信:")
+                logger.debug(f"  Hex: {data.hex()}")
+                logger.debug(f"  長さ: {len(data)} bytes")
             
             # バイト列で終了フレーム検出
             if data.startswith(b'EN'):
-                print("  → 最終フレーム（データ取得完了）")
-                self.measurement_complete = True
+                logger.info("  → 最終フレーム（データ取得完了）")
                 self.data_acquisition_time = datetime.now()  # 取得完了時刻を記録
+                # bleakのコールバックはイベントループ上で呼ばれるため直接set()できる
+                self.measurement_complete.set()
                 return
             
             # バイナリデータの場合、温度データをパース
             if len(data) >= 2 and len(data) % 2 == 0:
-                print("  温度データ:")
-                # 2バイトずつ処理（時間間隔 + 温度）
-                for i in range(0, len(data), 2):
-                    interval_byte = data[i]
-                    temp_byte = data[i + 1]
-                    
-                    temperature = self.calculate_temperature(temp_byte)
-                    print(f"    [{i//2}] 間隔={interval_byte}分, 温度={temperature:.2f}°C")
-                    
-                    self.data_buffer.append({
-                        'interval': interval_byte,
-                        'temperature': temperature,
-                        'raw_temp_byte': temp_byte
-                    })
+                count = parse_packet(data, self.intervals, self.temps, self.raw_bytes)
+
+                if debug:
+                    logger.debug("  温度データ:")
+                    start = len(self.temps) - count
+                    for i in range(count):
+                        logger.debug(f"    [{i}] 間隔={self.intervals[start + i]}分, "
+                                     f"温度={self.temps[start + i]:.2f}°C")
             
-            print("-" * 70)
+            if debug:
+                logger.debug("-" * 70)
         
         # start_notify()が自動的にCCCDを設定してIndicationを有効化する
         await self.client.start_notify(READ_CHAR_UUID, notification_handler)
@@ -106,8 +173,10 @@ class HalshareReader:
         コマンドを送信
         APKの実装に基づき、文字列 + 改行コード
         """
-        # UTF-8エンコード + 改行（0x0A）
-        command_bytes = (command_str + "\n").encode('utf-8')
+        # UTF-8エンコード + 改行（0x0A）、同じコマンドは初回のみエンコード
+        command_bytes = _CMD_CACHE.get(command_str)
+        if command_bytes is None:
+            command_bytes = _CMD_CACHE[command_str] = (command_str + "\n").encode('utf-8')
         
         print(f"コマンド送信: {repr(command_str)}")
         print(f"  バイト列: {command_bytes.hex()}")
@@ -133,14 +202,10 @@ class HalshareReader:
         # データ受信完了まで待機
         print(f"データ受信待機中（最大{timeout}秒）...\n")
         
-        start_time = asyncio.get_event_loop().time()
-        while not self.measurement_complete:
-            await asyncio.sleep(0.1)
-            
-            # タイムアウトチェック
-            if asyncio.get_event_loop().time() - start_time > timeout:
-                print("⚠ タイムアウト")
-                break
+        try:
+            await asyncio.wait_for(self.measurement_complete.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            print("⚠ タイムアウト")
         
         # 通知停止
         await self.client.stop_notify(READ_CHAR_UUID)
@@ -149,42 +214,36 @@ class HalshareReader:
         print("データ取得完了")
         print("=" * 70)
         
-        return self.data_buffer
+        return len(self.temps)
     
     def generate_csv_data(self):
         """
-        取得したデータからCSV用のデータを生成
+        取得したデータからCSV用の行タプル（CSV_FIELDNAMES順）を
+        時系列順（古い→新しい）に1行ずつ生成するジェネレータ
         最後のデータが最新（データ取得完了時刻）、
         そこから遡って各データの時刻を計算
         """
-        if not self.data_buffer or not self.data_acquisition_time:
-            return []
+        if not self.temps or not self.data_acquisition_time:
+            return
         
-        csv_rows = []
+        # 全行共通の列
+        address = self.address
+        acquisition_epoch = int(self.data_acquisition_time.timestamp())
         
-        # 最後のデータの時刻から遡って計算
-        current_time = self.data_acquisition_time
+        # 先頭データが最後のデータから何分前か（intervals[1:] の合計）
+        # 以降は次のデータの間隔を引きながら進める
+        intervals = self.intervals
+        minutes_back = sum(intervals) - intervals[0]
+        next_intervals = chain(islice(intervals, 1, None), (0,))
         
-        # データは古い順に入っているので、逆順で処理して時刻を割り当て
-        for i in range(len(self.data_buffer) - 1, -1, -1):
-            data = self.data_buffer[i]
-            
-            csv_rows.append({
-                'halshareWearerName': WEARER_NAME,
-                'halshareId': self.address,
-                'datetime': current_time.strftime("%Y/%m/%d %H:%M:%S"),
-                'temperature': data['temperature']
-            })
-            
-            # 次（一つ前）のデータの時刻を計算
-            # interval分だけ遡る
-            if i > 0:  # まだ前のデータがある場合
-                current_time = current_time - timedelta(minutes=data['interval'])
-        
-        # 時系列順（古い→新しい）に並び替え
-        csv_rows.reverse()
-        
-        return csv_rows
+        for temperature, next_interval in zip(self.temps, next_intervals):
+            yield (
+                WEARER_NAME,
+                address,
+                format_timestamp(acquisition_epoch - 60 * minutes_back),
+                temperature
+            )
+            minutes_back -= next_interval
     
     async def disconnect(self):
         """切断"""
@@ -193,74 +252,75 @@ class HalshareReader:
             print("\n✓ デバイスから切断しました")
 
 
-def save_to_csv(csv_data, filename="output.csv"):
+def save_to_csv(csv_rows, filename="output.csv"):
     """
     CSVファイルに保存
+    csv_rowsはジェネレータ等のイテラブルでよく、1パスで書き出す
     温度以外の列はダブルクォートで囲む
     """
-    if not csv_data:
+    csv_rows = iter(csv_rows)
+    first_row = next(csv_rows, None)
+    if first_row is None:
         print("⚠ 保存するデータがありません")
         return
     
-    with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['halshareWearerName', 'halshareId', 'datetime', 'temperature']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, quoting=csv.QUOTE_NONNUMERIC)
+    with open(filename, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
         
-        writer.writeheader()
-        writer.writerows(csv_data)
+        writer.writerow(CSV_FIELDNAMES)
+        writer.writerow(first_row)
+        writer.writerows(csv_rows)
     
     print(f"\n✓ CSVファイルに保存しました: {filename}")
 
 
 async def main():
     """メイン処理"""
+    # パケット毎の受信ログはDEBUGレベル（既定では表示しない）
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    
     reader = HalshareReader(DEVICE_ADDRESS)
     
     try:
         # 接続
         await reader.connect()
         
-        # MTU変更（オプション、APKでは250に設定）
-        # 一部のシステムでは自動的に処理される
-        
         # 少し待機
         await asyncio.sleep(1)
         
         # 温度データ取得
-        measurements = await reader.get_temperature_data(timeout=60)
+        count = await reader.get_temperature_data(timeout=60)
         
         # 結果表示
-        if measurements:
-            print(f"\n取得した測定データ: {len(measurements)}件")
+        if count:
+            print(f"\n取得した測定データ: {count}件")
             print("\n測定結果一覧:")
             print("-" * 70)
-            for i, m in enumerate(measurements, 1):
-                print(f"{i:3d}. 温度: {m['temperature']:6.2f}°C "
-                      f"(間隔: {m['interval']:3d}分, "
-                      f"生データ: 0x{m['raw_temp_byte']:02x})")
+            samples = zip(reader.intervals, reader.temps, reader.raw_bytes)
+            for i, (interval, temperature, raw_temp_byte) in enumerate(samples, 1):
+                print(f"{i:3d}. 温度: {temperature:6.2f}°C "
+                      f"(間隔: {interval:3d}分, "
+                      f"生データ: 0x{raw_temp_byte:02x})")
             
-            # 統計
-            temps = [m['temperature'] for m in measurements]
+            # 統計（温度は生データの単調増加な一次変換なので、生データの整数で集計）
+            raw_bytes = reader.raw_bytes
             print("-" * 70)
-            print(f"平均温度: {sum(temps)/len(temps):.2f}°C")
-            print(f"最高温度: {max(temps):.2f}°C")
-            print(f"最低温度: {min(temps):.2f}°C")
-            
-            # CSV生成
-            csv_data = reader.generate_csv_data()
+            print(f"平均温度: {sum(raw_bytes) / count * CELSIUS_PER_LSB + BASE_TEMPERATURE:.2f}°C")
+            print(f"最高温度: {_TEMP_LUT[max(raw_bytes)]:.2f}°C")
+            print(f"最低温度: {_TEMP_LUT[min(raw_bytes)]:.2f}°C")
             
-            # CSV保存
+            # CSV保存（行は書き込みながら生成）
             output_filename = f"halshare_data_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-            save_to_csv(csv_data, output_filename)
+            save_to_csv(reader.generate_csv_data(), output_filename)
             
-            # CSVプレビュー
+            # CSVプレビュー（最初の5件だけ改めて生成）
             print("\nCSV出力プレビュー:")
             print("-" * 70)
-            for row in csv_data[:5]:  # 最初の5件を表示
-                print(f"{row['halshareWearerName']}, {row['halshareId']}, "
-                      f"{row['datetime']}, {row['temperature']}")
-            if len(csv_data) > 5:
-                print(f"... (残り {len(csv_data) - 5} 件)")
+            preview_rows = list(islice(reader.generate_csv_data(), 5))
+            for wearer_name, halshare_id, timestamp, temperature in preview_rows:
+                print(f"{wearer_name}, {halshare_id}, {timestamp}, {temperature}")
+            if preview_rows and count > len(preview_rows):
+                print(f"... (残り {count - len(preview_rows)} 件)")
         else:
             print("\n⚠ データが取得できませんでした")
         
@@ -3,14 +3,16 @@ from bleak import BleakScanner
 
 async def scan_devices():
     print("BLEデバイスをスキャン中...")
-    devices = await BleakScanner.discover(timeout=10.0, return_adv=True)
+    # デバイス名が"TM2101-SR"のものだけを受信時に記録（それ以外は保持しない）
+    filtered_devices = {}
     
-    # デバイス名が"TM2101-SR"のものだけをフィルタリング
-    filtered_devices = {
-        address: (device, adv_data)
-        for address, (device, adv_data) in devices.items()
-        if device.name and device.name.startswith("TM2101-SR")
-    }
+    def detection_callback(device, adv_data):
+        name = adv_data.local_name or device.name
+        if name and name.startswith("TM2101-SR"):
+            filtered_devices[device.address] = (device, adv_data)
+    
+    async with BleakScanner(detection_callback=detection_callback):
+        await asyncio.sleep(10.0)
     
     # 該当デバイスが見つからなかった場合
     if not filtered_devices: